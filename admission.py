@@ -0,0 +1,186 @@
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of admitted."""
+
+    def __init__(self, status_code: int, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures and lets a single probe through after ``reset_timeout``."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Raises ``Overloaded`` while open. Returns True if this request is the half-open probe."""
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        raise Overloaded(503, max(remaining, 1.0), "circuit open")
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+class ConcurrencyLimiter:
+    """At most ``max_concurrency`` in flight, ``max_queue`` waiting, each waiting at most ``queue_timeout``."""
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def acquire(self):
+        if self.semaphore.locked():
+            if self.waiting >= self.max_queue:
+                raise Overloaded(429, self.queue_timeout, "queue full")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise Overloaded(503, self.queue_timeout, "queue deadline exceeded")
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+
+class AdmissionController:
+    """Per-upstream concurrency limiter and circuit breaker, created on first use.
+
+    Configured from the environment:
+        MAX_CONCURRENCY        default in-flight limit per upstream
+        CONCURRENCY_OVERRIDES  per-upstream limits, e.g. "llm-chat=4,embedding-service=32"
+        MAX_QUEUE              requests allowed to wait per upstream before 429
+        QUEUE_TIMEOUT          seconds a request may wait for a slot before 503
+        BREAKER_FAILURES       consecutive failures that open the circuit
+        BREAKER_RESET          seconds the circuit stays open before a probe
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        max_queue: int = 64,
+        queue_timeout: float = 5.0,
+        overrides: Optional[Dict[str, int]] = None,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.overrides = overrides or {}
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.limiters: Dict[str, ConcurrencyLimiter] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        overrides = {}
+        for item in os.getenv("CONCURRENCY_OVERRIDES", "").split(","):
+            if "=" in item:
+                name, limit = item.rsplit("=", 1)
+                overrides[name.strip()] = int(limit)
+        return cls(
+            max_concurrency=int(os.getenv("MAX_CONCURRENCY", "16")),
+            max_queue=int(os.getenv("MAX_QUEUE", "64")),
+            queue_timeout=float(os.getenv("QUEUE_TIMEOUT", "5")),
+            overrides=overrides,
+            breaker_failures=int(os.getenv("BREAKER_FAILURES", "5")),
+            breaker_reset=float(os.getenv("BREAKER_RESET", "30")),
+        )
+
+    def limiter(self, key: str) -> ConcurrencyLimiter:
+        if key not in self.limiters:
+            limit = self.overrides.get(key, self.max_concurrency)
+            self.limiters[key] = ConcurrencyLimiter(limit, self.max_queue, self.queue_timeout)
+        return self.limiters[key]
+
+    def breaker(self, key: str) -> CircuitBreaker:
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+        return self.breakers[key]
+
+    @asynccontextmanager
+    async def slot(self, key: str):
+        """Admit one request to ``key`` or raise ``Overloaded``.
+
+        Yields the upstream's breaker; callers report the outcome with
+        ``record_success``/``record_failure`` since only they know which
+        errors are the upstream's fault.
+        """
+        breaker = self.breaker(key)
+        probe = breaker.allow()
+        limiter = self.limiter(key)
+        try:
+            await limiter.acquire()
+        except Overloaded:
+            if probe:
+                breaker.probing = False
+            raise
+        try:
+            yield breaker
+        finally:
+            limiter.release()
+            if probe:
+                # Let the next request probe if this one ended without reporting an outcome
+                breaker.probing = False
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        return {
+            key: {
+                "in_flight": limiter.in_flight,
+                "waiting": limiter.waiting,
+                "max_concurrency": limiter.max_concurrency,
+                "circuit": self.breaker(key).state,
+            }
+            for key, limiter in self.limiters.items()
+        }
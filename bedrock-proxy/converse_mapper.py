@@ -0,0 +1,308 @@
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+# Bedrock models that accept cachePoint blocks; others reject requests containing them
+PROMPT_CACHE_MODELS = [
+    prefix.strip()
+    for prefix in os.getenv(
+        "PROMPT_CACHE_MODELS",
+        "anthropic.claude-3-7-sonnet,anthropic.claude-3-5-haiku,anthropic.claude-sonnet-4,"
+        "anthropic.claude-opus-4,amazon.nova",
+    ).split(",")
+    if prefix.strip()
+]
+
+# Request fields where each model family accepts cachePoint blocks; families not listed accept all three.
+# Nova only takes checkpoints in system and messages, and rejects one in toolConfig.tools.
+CACHE_POINT_FIELDS = {
+    "amazon.nova": frozenset({"system", "messages"}),
+}
+ALL_CACHE_POINT_FIELDS = frozenset({"tools", "system", "messages"})
+
+# Bedrock only caches prefixes of at least this many tokens (1024 for most models)
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+
+STOP_REASONS = {
+    "end_turn": "stop",
+    "stop_sequence": "stop",
+    "max_tokens": "length",
+    "tool_use": "tool_calls",
+    "content_filtered": "content_filter",
+    "guardrail_intervened": "content_filter",
+}
+
+
+def cache_point_fields(model_id):
+    """Request fields (tools, system, messages) that may carry cache points for this model; empty if none"""
+    # Cross-region inference profiles prefix the model ID with a region group, e.g. "us."
+    for region_group in ("us.", "eu.", "apac.", "us-gov."):
+        if model_id.startswith(region_group):
+            model_id = model_id[len(region_group):]
+    if not any(model_id.startswith(prefix) for prefix in PROMPT_CACHE_MODELS):
+        return frozenset()
+    for prefix, fields in CACHE_POINT_FIELDS.items():
+        if model_id.startswith(prefix):
+            return fields
+    return ALL_CACHE_POINT_FIELDS
+
+
+def estimate_tokens(value):
+    """Rough token count (4 characters per token) used only to decide where cache points pay off"""
+    text = value if isinstance(value, str) else json.dumps(value)
+    return len(text) // 4
+
+
+def to_text_blocks(content):
+    """
+    Convert OpenAI message content to Converse text blocks
+
+    Args:
+        content: String or list of OpenAI content parts
+
+    Returns:
+        List of Converse content blocks
+    """
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [{"text": content}] if content else []
+
+    blocks = []
+    for part in content:
+        if isinstance(part, str):
+            blocks.append({"text": part})
+        elif part.get("type") == "text":
+            blocks.append({"text": part.get("text", "")})
+        else:
+            raise ValueError(f"Unsupported content part type '{part.get('type')}'")
+    return blocks
+
+
+def to_converse_message(message):
+    """
+    Convert one OpenAI chat message to a Converse message
+
+    Args:
+        message: OpenAI message with role user, assistant or tool
+
+    Returns:
+        Converse message dict with role and content blocks
+    """
+    role = message.get("role")
+
+    if role == "user":
+        return {"role": "user", "content": to_text_blocks(message.get("content"))}
+
+    if role == "assistant":
+        content = to_text_blocks(message.get("content"))
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            arguments = function.get("arguments") or "{}"
+            content.append({
+                "toolUse": {
+                    "toolUseId": tool_call.get("id"),
+                    "name": function.get("name"),
+                    "input": json.loads(arguments) if isinstance(arguments, str) else arguments,
+                }
+            })
+        return {"role": "assistant", "content": content}
+
+    if role == "tool":
+        # Tool results travel back to the model as part of a user turn
+        result = message.get("content")
+        result_blocks = to_text_blocks(result) if result else [{"text": ""}]
+        return {
+            "role": "user",
+            "content": [{"toolResult": {"toolUseId": message.get("tool_call_id"), "content": result_blocks}}],
+        }
+
+    raise ValueError(f"Unsupported message role '{role}'")
+
+
+def to_tool_config(tools, tool_choice):
+    """
+    Convert OpenAI tools and tool_choice to a Converse toolConfig
+
+    Args:
+        tools: List of OpenAI function tools
+        tool_choice: OpenAI tool_choice value ("auto", "required" or a named function)
+
+    Returns:
+        Converse toolConfig dict
+    """
+    tool_specs = []
+    for tool in tools:
+        if tool.get("type", "function") != "function":
+            continue
+        function = tool["function"]
+        tool_spec = {
+            "name": function["name"],
+            "inputSchema": {"json": function.get("parameters", {"type": "object", "properties": {}})},
+        }
+        # Converse rejects an empty description, so only send one when the client gave it
+        if function.get("description"):
+            tool_spec["description"] = function["description"]
+        tool_specs.append({"toolSpec": tool_spec})
+    tool_config = {"tools": tool_specs}
+
+    if tool_choice == "auto":
+        tool_config["toolChoice"] = {"auto": {}}
+    elif tool_choice == "required":
+        tool_config["toolChoice"] = {"any": {}}
+    elif isinstance(tool_choice, dict) and "function" in tool_choice:
+        tool_config["toolChoice"] = {"tool": {"name": tool_choice["function"]["name"]}}
+
+    return tool_config
+
+
+def to_converse_request(payload, model_id):
+    """
+    Translate an OpenAI chat completion request to Converse API keyword arguments
+
+    Cache points are placed after the tool schemas, after the system prompt and
+    after the conversation history preceding the latest user turn, as long as
+    the model supports prompt caching and the prefix up to that point is long
+    enough to be cached.
+
+    Args:
+        payload: OpenAI-style request body (messages, tools, sampling params)
+        model_id: Bedrock model ID
+
+    Returns:
+        Dict of keyword arguments for bedrock-runtime converse()
+    """
+    system = []
+    messages: List[Dict[str, Any]] = []
+    for message in payload.get("messages", []):
+        if message.get("role") in ("system", "developer"):
+            system.extend(to_text_blocks(message.get("content")))
+            continue
+
+        converse_message = to_converse_message(message)
+        # Converse requires alternating roles, so fold consecutive turns (e.g. parallel tool results) together
+        if messages and messages[-1]["role"] == converse_message["role"]:
+            messages[-1]["content"].extend(converse_message["content"])
+        else:
+            messages.append(converse_message)
+
+    request: Dict[str, Any] = {"modelId": model_id, "messages": messages}
+
+    inference_config = {}
+    max_tokens = payload.get("max_completion_tokens") or payload.get("max_tokens")
+    if max_tokens is not None:
+        inference_config["maxTokens"] = int(max_tokens)
+    if payload.get("temperature") is not None:
+        inference_config["temperature"] = float(payload["temperature"])
+    if payload.get("top_p") is not None:
+        inference_config["topP"] = float(payload["top_p"])
+    stop = payload.get("stop")
+    if stop:
+        inference_config["stopSequences"] = [stop] if isinstance(stop, str) else list(stop)
+    if inference_config:
+        request["inferenceConfig"] = inference_config
+
+    tools = payload.get("tools")
+    tool_choice = payload.get("tool_choice", "auto")
+    if tools and tool_choice == "none":
+        # Converse cannot define tools while forbidding their use, so leave them out. That is only
+        # valid while no earlier turn used a tool, since toolUse/toolResult blocks need a toolConfig.
+        if any("toolUse" in block or "toolResult" in block for message in messages for block in message["content"]):
+            raise ValueError("tool_choice 'none' is not supported once the conversation contains tool calls")
+    elif tools:
+        request["toolConfig"] = to_tool_config(tools, tool_choice)
+    if system:
+        request["system"] = system
+
+    fields = cache_point_fields(model_id) if payload.get("prompt_cache", True) else frozenset()
+    if fields:
+        add_cache_points(request, fields)
+
+    return request
+
+
+def add_cache_points(request, fields=ALL_CACHE_POINT_FIELDS):
+    """Append cachePoint blocks after each stable prefix long enough to be cached, in the given fields only"""
+    # Converse prefix order is tools, then system, then messages. A field without a checkpoint still
+    # counts towards the prefix cached by the next one.
+    prefix_tokens = 0
+    tool_config = request.get("toolConfig")
+    if tool_config:
+        prefix_tokens += estimate_tokens(tool_config["tools"])
+        if "tools" in fields and prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            tool_config["tools"].append(CACHE_POINT)
+
+    if request.get("system"):
+        prefix_tokens += estimate_tokens(request["system"])
+        if "system" in fields and prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            request["system"].append(CACHE_POINT)
+
+    # History before the latest user turn is what the next call will resend unchanged
+    messages = request["messages"]
+    if len(messages) >= 2:
+        history = messages[:-1]
+        prefix_tokens += estimate_tokens(history)
+        if "messages" in fields and prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            history[-1]["content"].append(CACHE_POINT)
+
+
+def from_converse_response(response, model):
+    """
+    Normalize a Converse response to an OpenAI chat completion
+
+    Args:
+        response: bedrock-runtime converse() response
+        model: Model ID to report back to the client
+
+    Returns:
+        OpenAI-style chat completion dict including usage with cache token counts
+    """
+    texts = []
+    tool_calls = []
+    for block in response.get("output", {}).get("message", {}).get("content", []):
+        if "text" in block:
+            texts.append(block["text"])
+        elif "toolUse" in block:
+            tool_use = block["toolUse"]
+            tool_calls.append({
+                "id": tool_use.get("toolUseId"),
+                "type": "function",
+                "function": {"name": tool_use.get("name"), "arguments": json.dumps(tool_use.get("input", {}))},
+            })
+
+    message: Dict[str, Optional[Any]] = {"role": "assistant", "content": "".join(texts) if texts else None}
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+
+    usage = response.get("usage", {})
+    cache_read = usage.get("cacheReadInputTokens", 0)
+    cache_write = usage.get("cacheWriteInputTokens", 0)
+    # Bedrock's inputTokens excludes cached tokens; OpenAI's prompt_tokens includes them
+    prompt_tokens = usage.get("inputTokens", 0) + cache_read + cache_write
+    completion_tokens = usage.get("outputTokens", 0)
+
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": STOP_REASONS.get(response.get("stopReason"), "stop"),
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cache_read},
+            "cache_read_input_tokens": cache_read,
+            "cache_write_input_tokens": cache_write,
+        },
+    }
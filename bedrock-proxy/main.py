@@ -1,22 +1,195 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional
+import asyncio
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import json
 import os
 import logging
+import time
+from contextlib import asynccontextmanager
+from admission import AdmissionController, Overloaded
+from chunking import approximate_token_offsets, parse_chunking_options, pool, split_text
+from converse_mapper import from_converse_response, to_converse_request
 from model_mapper import map_to_bedrock_model_id
+from usage_ledger import UsageLedger, tenant_from
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+usage_ledger = UsageLedger.from_env()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Don't lose the last partial accounting window on shutdown
+    usage_ledger.flush()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Hardcode region to us-east-1 regardless of environment variable
 region = "us-east-1"
 logger.info(f"Using hardcoded AWS region: {region}")
-bedrock = boto3.client("bedrock-runtime", region_name=region)
+admission = AdmissionController.from_env()
+
+# Bedrock calls run in worker threads; size the connection pool to the admitted concurrency
+bedrock = boto3.client(
+    "bedrock-runtime",
+    region_name=region,
+    config=Config(max_pool_connections=max([admission.max_concurrency, *admission.overrides.values()]) * 2),
+)
+
+# Bedrock errors that mean the model endpoint is unhealthy or saturated, not that the request was bad
+UPSTREAM_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+}
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in UPSTREAM_ERROR_CODES or status >= 500
+    return True
+
+
+def is_throttled(error: Exception) -> bool:
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") == "ThrottlingException"
+
+
+def bedrock_usage(response: Dict[str, Any], raw_output: Dict[str, Any], elapsed: float):
+    """Token counts and latency for an invoke_model call as (prompt_tokens, completion_tokens, seconds).
+
+    Bedrock reports these uniformly in response headers; fall back to the model-specific body fields.
+    """
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    prompt_tokens = headers.get("x-amzn-bedrock-input-token-count")
+    completion_tokens = headers.get("x-amzn-bedrock-output-token-count")
+    latency_ms = headers.get("x-amzn-bedrock-invocation-latency")
+
+    if prompt_tokens is None:
+        prompt_tokens = (
+            raw_output.get("prompt_token_count")  # Llama
+            or raw_output.get("inputTextTokenCount")  # Titan
+            or raw_output.get("usage", {}).get("input_tokens")  # Claude
+            or 0
+        )
+    if completion_tokens is None:
+        completion_tokens = (
+            raw_output.get("generation_token_count")
+            or raw_output.get("usage", {}).get("output_tokens")
+            or sum(result.get("tokenCount", 0) for result in raw_output.get("results", []))
+        )
+    seconds = int(latency_ms) / 1000 if latency_ms is not None else elapsed
+    return int(prompt_tokens), int(completion_tokens), seconds
+
+
+# Server-side chunking windows for /embed, counted in approximate tokens (see chunking.approximate_token_offsets).
+# The estimate is not Titan's tokenizer, so the maximum leaves headroom below its 8k limit.
+EMBED_CHUNK_TOKENS = int(os.getenv("EMBED_CHUNK_TOKENS", "2048"))
+EMBED_CHUNK_OVERLAP = int(os.getenv("EMBED_CHUNK_OVERLAP", "128"))
+EMBED_MAX_CHUNK_TOKENS = int(os.getenv("EMBED_MAX_CHUNK_TOKENS", "5000"))
+# Windows of one request embedded concurrently; keep well below MAX_CONCURRENCY so one long
+# document cannot fill the model's admission queue by itself
+EMBED_CHUNK_PARALLELISM = int(os.getenv("EMBED_CHUNK_PARALLELISM", "4"))
+
+
+async def embed_text(model_id: str, text: str):
+    """Embed one text with a Bedrock model. Returns (embedding, prompt_tokens, seconds)."""
+    started = time.monotonic()
+    response = await invoke_bedrock(model_id, {"inputText": text})
+    raw_output = json.loads(response["body"])
+    prompt_tokens, _, seconds = bedrock_usage(response, raw_output, time.monotonic() - started)
+    logger.info(f"Received raw embedding output from Bedrock (showing length only): {len(str(raw_output))} chars")
+
+    # Format embedding response to be more consistent
+    if "embedding" in raw_output:
+        embeddings = raw_output["embedding"]
+    elif "embeddings" in raw_output:
+        embeddings = raw_output["embeddings"]
+    else:
+        # Try to extract from common patterns
+        embeddings = raw_output.get("data", [{}])[0].get("embedding", [])
+    return embeddings, prompt_tokens, seconds
+
+
+async def embed_windows(model_id: str, texts: List[str]):
+    """
+    Embed the windows of one chunked input with bounded parallelism
+
+    At most EMBED_CHUNK_PARALLELISM windows hold an admission slot at a time. The
+    first failure cancels the windows that have not completed yet; calls already
+    handed to Bedrock still finish in their worker thread.
+
+    Returns:
+        List of (embedding, prompt_tokens, seconds) in window order
+    """
+    semaphore = asyncio.Semaphore(EMBED_CHUNK_PARALLELISM)
+
+    async def embed_window(text):
+        async with semaphore:
+            return await embed_text(model_id, text)
+
+    tasks = [asyncio.create_task(embed_window(text)) for text in texts]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def overloaded_response(error: Overloaded, model_id: str) -> JSONResponse:
+    logger.warning(f"Shedding request for model {model_id}: {error.reason}")
+    return JSONResponse(
+        content={"error": f"Model {model_id} overloaded: {error.reason}", "model": model_id},
+        status_code=error.status_code,
+        headers=error.headers,
+    )
+
+
+async def call_bedrock(model_id: str, call) -> Dict[str, Any]:
+    """Run a blocking Bedrock call through the model's admission slot, off the event loop."""
+    async with admission.slot(model_id) as breaker:
+        try:
+            response = await asyncio.to_thread(call)
+        except Exception as e:
+            if is_upstream_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        return response
+
+
+async def invoke_bedrock(model_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    """Invoke a Bedrock model. The response body is read in the worker thread too, so callers get bytes."""
+    def call():
+        response = bedrock.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            body=json.dumps(body)
+        )
+        response["body"] = response["body"].read()
+        return response
+
+    return await call_bedrock(model_id, call)
+
+
+async def converse_bedrock(request: Dict[str, Any]) -> Dict[str, Any]:
+    """Call the Converse API with keyword arguments built by to_converse_request."""
+    return await call_bedrock(request["modelId"], lambda: bedrock.converse(**request))
+
 
 class Message(BaseModel):
     role: str
@@ -49,46 +222,36 @@ async def chat(request: Request):
         raw_data = await request.json()
         logger.info(f"Received request: {raw_data}")
         
-        # Extract prompt from different possible formats
-        prompt = ""
+        # Normalize the different request formats to an OpenAI-style chat payload
         model_id = "meta.llama3-8b-instruct-v1:0"
+        payload: Dict[str, Any] = {}
         
         # Check for messages format (unwrapped Dapr format)
         if "messages" in raw_data and isinstance(raw_data["messages"], list) and len(raw_data["messages"]) > 0:
             logger.info("Detected unwrapped messages format")
-            messages = raw_data["messages"]
-            
-            if isinstance(messages[0], dict) and "content" in messages[0]:
-                prompt = messages[0]["content"]
-                logger.info(f"Extracted prompt from messages: '{prompt[:50]}...'")
-            
-            # Get model ID if present
-            if "model" in raw_data:
-                model_id = raw_data["model"]
+            payload = raw_data
+            model_id = raw_data.get("model", model_id)
         
         # Check for Dapr binding format (shouldn't happen with Dapr sidecar, but kept for direct testing)
         elif "operation" in raw_data and "data" in raw_data:
             logger.info("Detected Dapr binding format")
-            data = raw_data.get("data", {})
-            model_id = data.get("model", model_id)
-            
-            messages = data.get("messages", [])
-            if messages and isinstance(messages, list) and len(messages) > 0:
-                message = messages[0]
-                if isinstance(message, dict):
-                    prompt = message.get("content", "")
-                    logger.info(f"Extracted prompt from Dapr binding: '{prompt[:50]}...'")
+            payload = raw_data.get("data", {})
+            model_id = payload.get("model", model_id)
+            if "prompt" in payload and not payload.get("messages"):
+                payload = {**payload, "messages": [{"role": "user", "content": payload["prompt"]}]}
         
         # Check for direct API call format 
         elif "prompt" in raw_data:
             logger.info("Detected direct API call format")
-            prompt = raw_data.get("prompt", "")
             model_id = raw_data.get("model_id", model_id)
-            logger.info(f"Extracted from direct call: model_id={model_id}, prompt={prompt[:50]}...")
+            payload = {**raw_data, "messages": [{"role": "user", "content": raw_data.get("prompt", "")}]}
+            logger.info(f"Extracted from direct call: model_id={model_id}, prompt={raw_data.get('prompt', '')[:50]}...")
         
+        tenant = tenant_from(request.headers, payload or raw_data)
+
         # Validate required fields
-        if not prompt:
-            error_msg = "Missing prompt in request"
+        if not payload.get("messages"):
+            error_msg = "Missing messages or prompt in request"
             logger.error(f"{error_msg}. Raw data: {raw_data}")
             return {"error": error_msg}
         
@@ -103,43 +266,36 @@ async def chat(request: Request):
         
         logger.info(f"Mapped model ID '{original_model_id}' to Bedrock model '{bedrock_model_id}'")
         
-        if bedrock_model_id.startswith("meta.llama"):
-            # Meta Llama models expect a 'prompt' field
-            body = {
-                "prompt": prompt,
-                "temperature": 0.7
-            }
-        else:
-            # Claude and other models use 'messages' format
-            body = {
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.7
-            }
+        try:
+            converse_request = to_converse_request(payload, bedrock_model_id)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Could not translate request to Converse: {str(e)}")
+            return {"error": f"Invalid chat request: {str(e)}"}
         
         try:
-            response = bedrock.invoke_model(
-                modelId=bedrock_model_id,
-                contentType="application/json",
-                body=json.dumps(body)
+            started = time.monotonic()
+            response = await converse_bedrock(converse_request)
+            logger.info(f"Received Converse output from Bedrock: {response.get('output')}")
+
+            normalized = from_converse_response(response, original_model_id)
+            usage = normalized["usage"]
+            seconds = response.get("metrics", {}).get("latencyMs", (time.monotonic() - started) * 1000) / 1000
+            usage_ledger.record(
+                tenant,
+                bedrock_model_id,
+                usage["prompt_tokens"],
+                usage["completion_tokens"],
+                seconds,
+                cached_tokens=usage["cache_read_input_tokens"],
             )
-            raw_output = json.loads(response["body"].read())
-            logger.info(f"Received raw output from Bedrock: {raw_output}")
-            
-            # Normalize to OpenAI-style response
-            normalized = {
-                "choices": [
-                    {
-                        "message": {
-                            "role": "assistant",
-                            "content": extract_content(raw_output, bedrock_model_id)
-                        }
-                    }
-                ],
-                "model": original_model_id  # Return the original model ID for compatibility
-            }
+            normalized["generation_seconds"] = round(seconds, 3)
             logger.info(f"Returning normalized response: {normalized}")
             return normalized
+        except Overloaded as e:
+            return overloaded_response(e, original_model_id)
         except Exception as e:
+            if is_throttled(e):
+                return overloaded_response(Overloaded(429, admission.queue_timeout, "throttled by Bedrock"), original_model_id)
             logger.error(f"Error invoking Bedrock model: {str(e)}")
             # Return a structured error response
             return {
@@ -158,62 +314,6 @@ async def chat(request: Request):
         logger.exception(f"Unexpected error processing request: {str(e)}")
         return {"error": f"Error processing request: {str(e)}"}
 
-
-def extract_content(output, model_id):
-    """Extract content from different model responses"""
-    try:
-        # Llama models
-        if model_id.startswith("meta.llama"):
-            if "generation" in output:
-                return output["generation"]
-            elif "completion" in output:
-                return output["completion"]
-        
-        # Claude models
-        elif model_id.startswith("anthropic.claude"):
-            if "completion" in output:
-                return output["completion"]
-            elif "content" in output and isinstance(output["content"], list):
-                # Extract text from content array
-                texts = [item.get("text", "") for item in output["content"] if item.get("type") == "text"]
-                return "".join(texts)
-            elif "content" in output:
-                return output["content"]
-        
-        # Amazon Titan models
-        elif model_id.startswith("amazon.titan"):
-            if "results" in output and len(output["results"]) > 0:
-                return output["results"][0].get("outputText", "")
-            elif "outputText" in output:
-                return output["outputText"]
-        
-        # Check common patterns across models
-        if "generation" in output:
-            return output["generation"]
-        elif "outputs" in output and len(output["outputs"]) > 0:
-            if isinstance(output["outputs"][0], dict):
-                return output["outputs"][0].get("text", "")
-            else:
-                return str(output["outputs"][0])
-        elif "content" in output:
-            if isinstance(output["content"], list):
-                texts = []
-                for item in output["content"]:
-                    if isinstance(item, dict) and "text" in item:
-                        texts.append(item["text"])
-                    elif isinstance(item, str):
-                        texts.append(item)
-                return "".join(texts)
-            return output["content"]
-        elif "text" in output:
-            return output["text"]
-        
-        # Last resort: Return the raw output as string
-        return str(output)
-    except Exception as e:
-        logger.error(f"Error extracting content: {str(e)}")
-        return f"Error extracting response content: {str(e)}"
-
 @app.post("/embed")
 async def embed(request: Request):
     try:
@@ -244,11 +344,25 @@ async def embed(request: Request):
             model_id = raw_data.get("model_id", "amazon.titan-embed-text-v1")
             logger.info(f"Direct API call: model_id={model_id}, input_text={input_text[:30]}...")
         
+        tenant = tenant_from(request.headers, raw_data.get("data", raw_data))
+
         # Validate required fields
         if not input_text:
             error_msg = "Missing input text in request"
             logger.error(error_msg)
             return {"error": error_msg}
+
+        # Optional server-side chunking of long inputs into pooled windows
+        try:
+            chunking_options = parse_chunking_options(
+                raw_data.get("data", raw_data).get("chunking"),
+                default_window=EMBED_CHUNK_TOKENS,
+                max_window=EMBED_MAX_CHUNK_TOKENS,
+                default_overlap=EMBED_CHUNK_OVERLAP,
+            )
+        except ValueError as e:
+            logger.error(f"Invalid chunking options: {str(e)}")
+            return {"error": str(e)}
         
         # Map the client model ID to a Bedrock embedding model ID
         original_model_id = model_id
@@ -262,33 +376,43 @@ async def embed(request: Request):
         logger.info(f"Mapped embedding model ID '{original_model_id}' to Bedrock model '{bedrock_model_id}'")
         
         try:
-            body = {"inputText": input_text}
-            response = bedrock.invoke_model(
-                modelId=bedrock_model_id,
-                contentType="application/json",
-                body=json.dumps(body)
-            )
-            raw_output = json.loads(response["body"].read())
-            logger.info(f"Received raw embedding output from Bedrock (showing length only): {len(str(raw_output))} chars")
-            
-            # Format embedding response to be more consistent
-            if "embedding" in raw_output:
-                embeddings = raw_output["embedding"]
-            elif "embeddings" in raw_output:
-                embeddings = raw_output["embeddings"]
+            if chunking_options is not None:
+                # Windows run with bounded parallelism, each through the model's admission slot
+                started = time.monotonic()
+                chunks = split_text(input_text, approximate_token_offsets(input_text), chunking_options)
+                results = await embed_windows(bedrock_model_id, [chunk["text"] for chunk in chunks])
+                chunk_vectors = [embedding for embedding, _, _ in results]
+                chunk_tokens = [tokens for _, tokens, _ in results]
+                prompt_tokens = sum(chunk_tokens)
+                seconds = time.monotonic() - started
+                item = {
+                    "embedding": pool(chunk_vectors, chunk_tokens, chunking_options),
+                    "num_chunks": len(chunks),
+                }
+                if chunking_options.return_chunks:
+                    item["chunks"] = [
+                        {"embedding": vector, "start": chunk["start"], "end": chunk["end"], "tokens": tokens}
+                        for chunk, vector, tokens in zip(chunks, chunk_vectors, chunk_tokens)
+                    ]
+                logger.info(f"Embedded {len(chunks)} chunks into a pooled vector of length: {len(item['embedding'])}")
             else:
-                # Try to extract from common patterns
-                embeddings = raw_output.get("data", [{}])[0].get("embedding", [])
-            
-            logger.info(f"Extracted embeddings of length: {len(embeddings)}")
+                embeddings, prompt_tokens, seconds = await embed_text(bedrock_model_id, input_text)
+                item = {"embedding": embeddings}
+                logger.info(f"Extracted embeddings of length: {len(embeddings)}")
+            usage_ledger.record(tenant, bedrock_model_id, prompt_tokens, 0, seconds)
             
             embedding_response = {
-                "data": [{"embedding": embeddings}],
-                "model": original_model_id  # Return the original model ID for compatibility
+                "data": [item],
+                "model": original_model_id,  # Return the original model ID for compatibility
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
             }
             
             return embedding_response
+        except Overloaded as e:
+            return overloaded_response(e, original_model_id)
         except Exception as e:
+            if is_throttled(e):
+                return overloaded_response(Overloaded(429, admission.queue_timeout, "throttled by Bedrock"), original_model_id)
             logger.error(f"Error invoking Bedrock embedding model: {str(e)}")
             return {
                 "error": str(e),
@@ -301,3 +425,13 @@ async def embed(request: Request):
 @app.get("/health")
 def health():
     return {"status": "ok"}
+
+
+@app.get("/admission")
+def admission_stats():
+    return admission.stats()
+
+
+@app.get("/usage")
+def usage(tenant: Optional[str] = None, model: Optional[str] = None):
+    return usage_ledger.snapshot(tenant=tenant, model=model)
@@ -0,0 +1,136 @@
+import math
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+POOLING_MODES = ("mean", "weighted")
+
+# Scripts written without spaces between words (CJK ideographs, kana, hangul) count one token per character;
+# other word characters count one token per 4 characters, roughly what subword tokenizers produce
+_UNSPACED = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_PATTERN = re.compile(rf"[{_UNSPACED}]|[^\W{_UNSPACED}]{{1,4}}|[^\w\s]")
+
+
+class ChunkingOptions:
+    """How to split long inputs into overlapping token windows and pool them back into one vector."""
+
+    __slots__ = ("window_tokens", "overlap_tokens", "pooling", "normalize", "return_chunks")
+
+    def __init__(
+        self,
+        window_tokens: int,
+        overlap_tokens: int = 0,
+        pooling: str = "mean",
+        normalize: bool = True,
+        return_chunks: bool = False,
+    ):
+        if window_tokens < 1:
+            raise ValueError("'window_tokens' must be at least 1")
+        if not 0 <= overlap_tokens < window_tokens:
+            raise ValueError("'overlap_tokens' must be at least 0 and smaller than 'window_tokens'")
+        if pooling not in POOLING_MODES:
+            raise ValueError(f"Unsupported pooling '{pooling}', expected one of {POOLING_MODES}")
+        self.window_tokens = window_tokens
+        self.overlap_tokens = overlap_tokens
+        self.pooling = pooling
+        self.normalize = normalize
+        self.return_chunks = return_chunks
+
+
+def parse_chunking_options(
+    value: Any, default_window: int, max_window: int, default_overlap: int = 0
+) -> Optional[ChunkingOptions]:
+    """Builds options from a request's ``chunking`` field.
+
+    ``None``/``False`` disables chunking, ``True`` uses the defaults and a dict
+    overrides any of ``window_tokens``, ``overlap_tokens``, ``pooling``,
+    ``normalize`` and ``return_chunks``. Raises ``ValueError`` on bad input.
+    """
+    if value is None or value is False:
+        return None
+    if value is True:
+        value = {}
+    if not isinstance(value, dict):
+        raise ValueError("'chunking' must be a boolean or an object")
+
+    try:
+        window_tokens = int(value.get("window_tokens", default_window))
+        overlap_tokens = int(value.get("overlap_tokens", min(default_overlap, window_tokens - 1)))
+    except TypeError:
+        # e.g. null or a list, which int() rejects with TypeError rather than ValueError
+        raise ValueError("'window_tokens' and 'overlap_tokens' must be integers")
+    if window_tokens > max_window:
+        raise ValueError(f"'window_tokens' may be at most {max_window}")
+    return ChunkingOptions(
+        window_tokens=window_tokens,
+        overlap_tokens=overlap_tokens,
+        pooling=value.get("pooling", "mean"),
+        normalize=bool(value.get("normalize", True)),
+        return_chunks=bool(value.get("return_chunks", False)),
+    )
+
+
+def approximate_token_offsets(text: str) -> List[Tuple[int, int]]:
+    """Approximate token spans, a stand-in where the model's tokenizer is not available.
+
+    Words are split into pieces of at most four characters, unspaced scripts
+    into single characters and punctuation marks count on their own, so long
+    unbroken runs never collapse into one token. Real token counts still
+    vary by model, so windows should be sized with headroom below its limit.
+    """
+    return [match.span() for match in _TOKEN_PATTERN.finditer(text)]
+
+
+def token_windows(num_tokens: int, window_tokens: int, overlap_tokens: int) -> List[Tuple[int, int]]:
+    """Half-open ``[start, end)`` token ranges covering ``num_tokens`` with the given overlap."""
+    if num_tokens <= window_tokens:
+        return [(0, num_tokens)]
+    stride = window_tokens - overlap_tokens
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window_tokens, num_tokens)
+        windows.append((start, end))
+        if end == num_tokens:
+            return windows
+        start += stride
+
+
+def split_text(
+    text: str, offsets: Sequence[Tuple[int, int]], options: ChunkingOptions
+) -> List[Dict[str, Any]]:
+    """Splits ``text`` into windows over its token ``offsets``.
+
+    Each chunk has its ``text``, character ``start``/``end`` and token count.
+    """
+    if not offsets:
+        return [{"text": text, "start": 0, "end": len(text), "tokens": 0}]
+    chunks = []
+    for start, end in token_windows(len(offsets), options.window_tokens, options.overlap_tokens):
+        char_start, char_end = offsets[start][0], offsets[end - 1][1]
+        chunks.append({
+            "text": text[char_start:char_end],
+            "start": char_start,
+            "end": char_end,
+            "tokens": end - start,
+        })
+    return chunks
+
+
+def pool(vectors: Sequence[Sequence[float]], token_counts: Sequence[int], options: ChunkingOptions) -> List[float]:
+    """Combines chunk vectors into one, weighting by token count for ``weighted`` pooling."""
+    if options.pooling == "weighted":
+        weights = [max(count, 1) for count in token_counts]
+    else:
+        weights = [1] * len(vectors)
+    total = sum(weights)
+
+    pooled = [0.0] * len(vectors[0])
+    for vector, weight in zip(vectors, weights):
+        for i, value in enumerate(vector):
+            pooled[i] += value * weight / total
+
+    if options.normalize:
+        norm = math.sqrt(sum(value * value for value in pooled))
+        if norm > 0:
+            pooled = [value / norm for value in pooled]
+    return pooled
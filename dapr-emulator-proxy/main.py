@@ -1,10 +1,32 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 import httpx, os
 
+from admission import AdmissionController, Overloaded
+
 DAPR_HOST = os.getenv("DAPR_HOST", "http://localhost:3500")  # inside the Pod
 TIMEOUT    = 30  # seconds
 
-app = FastAPI()
+admission = AdmissionController.from_env()
+client: httpx.AsyncClient = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for all bindings, sized to what admission lets through
+    global client
+    max_connections = max([admission.max_concurrency, *admission.overrides.values()])
+    client = httpx.AsyncClient(
+        timeout=TIMEOUT,
+        limits=httpx.Limits(max_connections=max_connections * 2, max_keepalive_connections=max_connections),
+    )
+    yield
+    await client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 @app.api_route("/v1.0/bindings/{binding_name}", methods=["POST"])
 async def invoke_binding(binding_name: str, request: Request):
@@ -12,11 +34,35 @@ async def invoke_binding(binding_name: str, request: Request):
     headers = {k: v for k, v in request.headers.items() if k != "host"}
 
     target = f"{DAPR_HOST}/v1.0/bindings/{binding_name}"
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        dapr_resp = await client.post(target, content=body, headers=headers)
+    try:
+        async with admission.slot(binding_name) as breaker:
+            try:
+                dapr_resp = await client.post(target, content=body, headers=headers)
+            except httpx.HTTPError:
+                breaker.record_failure()
+                raise
+            if dapr_resp.status_code >= 500 or dapr_resp.status_code == 429:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+    except Overloaded as e:
+        return JSONResponse(
+            content={"error": f"Binding '{binding_name}' overloaded: {e.reason}"},
+            status_code=e.status_code,
+            headers=e.headers,
+        )
+    except httpx.TimeoutException:
+        return JSONResponse(content={"error": f"Binding '{binding_name}' timed out"}, status_code=504)
+    except httpx.HTTPError as e:
+        return JSONResponse(content={"error": f"Binding '{binding_name}' unreachable: {e}"}, status_code=502)
 
     return Response(
         content=dapr_resp.content,
         status_code=dapr_resp.status_code,
         media_type=dapr_resp.headers.get("content-type", "application/json"),
     )
+
+
+@app.get("/admission")
+def admission_stats():
+    return admission.stats()
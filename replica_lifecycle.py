@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+from typing import Any, AsyncGenerator, Dict, Optional
+
+logger = logging.getLogger("ray.serve")
+
+
+class AdmissionSlot:
+    """One admitted request. ``release`` is idempotent so every cleanup path may call it."""
+
+    __slots__ = ("_lifecycle", "released")
+
+    def __init__(self, lifecycle: "ReplicaLifecycle"):
+        self._lifecycle = lifecycle
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._lifecycle.release()
+
+
+class ReplicaLifecycle:
+    """Warmup, slow start and stream time-boxing for one serving replica.
+
+    Ray Serve only routes to a replica once its constructor and
+    ``reconfigure`` have returned, and on scale-down or rollout it stops
+    routing to the old replica and waits up to ``graceful_shutdown_timeout_s``
+    for ongoing requests before killing it. This class covers the gaps:
+
+    - the deployment warms the engine in ``reconfigure`` and then calls
+      ``mark_ready``, so the first routed request does not pay for it;
+    - with ``ramp_seconds`` set, admission capacity ramps linearly from
+      ``ramp_min_fraction`` to ``max_concurrency`` after ``mark_ready``.
+      Requests above the ramped capacity wait here and show up as ongoing
+      requests, so Ray's router shifts traffic to a new replica gradually.
+      The ramp is off by default: it only helps while other replicas can
+      absorb the traffic, and on a single replica it just throttles a rollout;
+    - with ``max_stream_seconds`` set, streams running longer are ended with a
+      terminal event. A replica cannot tell when Ray starts draining it, so
+      this is an opt-in cap for deployments whose streams would otherwise
+      outlive ``graceful_shutdown_timeout_s``; it is off by default.
+    """
+
+    def __init__(self):
+        self.max_concurrency = 32
+        self.ramp_seconds = 0.0
+        self.ramp_min_fraction = 0.1
+        self.max_stream_seconds: Optional[float] = None
+        self.state = "starting"
+        self.ready_at: Optional[float] = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.streams: Dict[str, float] = {}
+        self.streams_time_boxed = 0
+        self._released = asyncio.Event()
+
+    def configure(self, config: Dict[str, Any]):
+        self.max_concurrency = int(config.get("max_concurrency", self.max_concurrency))
+        self.ramp_seconds = float(config.get("ramp_seconds", self.ramp_seconds))
+        self.ramp_min_fraction = float(config.get("ramp_min_fraction", self.ramp_min_fraction))
+        max_stream_seconds = config.get("max_stream_seconds", self.max_stream_seconds)
+        self.max_stream_seconds = float(max_stream_seconds) if max_stream_seconds else None
+
+    def mark_ready(self):
+        if self.ready_at is None:
+            self.ready_at = time.monotonic()
+            self.state = "ready"
+            if self.ramp_seconds > 0:
+                logger.info(
+                    f"Replica ready, ramping to {self.max_concurrency} concurrent requests over {self.ramp_seconds}s"
+                )
+
+    def capacity(self) -> int:
+        if self.ready_at is None:
+            # Never warmed (no user_config), so there is nothing to ramp from
+            return self.max_concurrency
+        elapsed = time.monotonic() - self.ready_at
+        if self.ramp_seconds <= 0 or elapsed >= self.ramp_seconds:
+            return self.max_concurrency
+        fraction = self.ramp_min_fraction + (1 - self.ramp_min_fraction) * elapsed / self.ramp_seconds
+        return max(1, int(self.max_concurrency * fraction))
+
+    async def acquire(self) -> AdmissionSlot:
+        self.waiting += 1
+        try:
+            while self.in_flight >= self.capacity():
+                # Capacity also grows with time, so re-check periodically as well as on release
+                self._released.clear()
+                try:
+                    await asyncio.wait_for(self._released.wait(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return AdmissionSlot(self)
+
+    def release(self):
+        self.in_flight -= 1
+        self._released.set()
+
+    def hand_off(
+        self, generator: AsyncGenerator[str, None], request_id: str, slot: AdmissionSlot
+    ) -> AsyncGenerator[str, None]:
+        """Wraps a response stream that takes ownership of ``slot``.
+
+        The slot is released when the stream finishes or is closed, and also
+        when the stream is dropped without ever being iterated (e.g. the client
+        disconnected before the response started), whose ``finally`` never runs.
+        """
+        stream = self._stream(generator, request_id, slot)
+        weakref.finalize(stream, slot.release)
+        return stream
+
+    async def _stream(
+        self, generator: AsyncGenerator[str, None], request_id: str, slot: AdmissionSlot
+    ) -> AsyncGenerator[str, None]:
+        started = time.monotonic()
+        self.streams[request_id] = started
+        try:
+            async for chunk in generator:
+                yield chunk
+                if chunk.startswith("data: [DONE]"):
+                    # The stream already completed; nothing left to cut
+                    break
+                if self.max_stream_seconds is not None and time.monotonic() - started > self.max_stream_seconds:
+                    self.streams_time_boxed += 1
+                    logger.warning(f"Stream {request_id} exceeded {self.max_stream_seconds}s, ending it")
+                    error = {
+                        "message": f"Stream exceeded {self.max_stream_seconds}s on this replica",
+                        "type": "ServiceUnavailableError",
+                        "code": 503,
+                    }
+                    yield f"data: {json.dumps({'error': error})}\n\n"
+                    yield "data: [DONE]\n\n"
+                    break
+        finally:
+            # Closing the generator aborts the request in the engine
+            try:
+                await generator.aclose()
+            finally:
+                self.streams.pop(request_id, None)
+                slot.release()
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "state": self.state,
+            "capacity": self.capacity(),
+            "max_concurrency": self.max_concurrency,
+            "ramp_remaining_seconds": (
+                max(0.0, self.ramp_seconds - (now - self.ready_at)) if self.ready_at is not None else None
+            ),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "streams": len(self.streams),
+            "oldest_stream_seconds": round(now - min(self.streams.values()), 1) if self.streams else 0.0,
+            "max_stream_seconds": self.max_stream_seconds,
+            "streams_time_boxed": self.streams_time_boxed,
+        }
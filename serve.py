@@ -1,14 +1,22 @@
 import os
+import asyncio
+import json
+import time
+import uuid
 
-from typing import Dict, Optional, List
+from typing import Any, AsyncGenerator, Dict, Optional, List, Union
 import logging
 
 from fastapi import FastAPI
+from pydantic import BaseModel
 from starlette.requests import Request
+from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse, JSONResponse
 
 from ray import serve
+from ray.serve.exceptions import RayServeException
 
+from vllm import SamplingParams
 from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.engine.async_llm_engine import AsyncLLMEngine
 from vllm.entrypoints.openai.cli_args import make_arg_parser
@@ -16,8 +24,10 @@ from vllm.entrypoints.openai.protocol import (
     ChatCompletionRequest,
     ChatCompletionResponse,
     ErrorResponse,
+    EmbeddingCompletionRequest,
     EmbeddingRequest,
     EmbeddingResponse,
+    StreamOptions,
 )
 from vllm.entrypoints.openai.serving_chat import OpenAIServingChat
 from vllm.entrypoints.openai.serving_embedding import OpenAIServingEmbedding
@@ -30,6 +40,11 @@ from vllm.entrypoints.openai.serving_models import (
 from vllm.utils import FlexibleArgumentParser
 from vllm.entrypoints.logger import RequestLogger
 
+from chunking import parse_chunking_options, pool, split_text
+from replica_lifecycle import ReplicaLifecycle
+from usage_ledger import UsageLedger, tenant_from
+from vector_index import VectorIndex
+
 logger = logging.getLogger("ray.serve")
 
 chat_app = FastAPI()
@@ -86,16 +101,35 @@ class VLLMDeployment:
         # self.enable_auto_tools = enable_auto_tools
         # self.tool_parser = tool_parser
         self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+        self.served_model_name = None
+        self.usage_ledger = UsageLedger.from_env()
+        self.lifecycle = ReplicaLifecycle()
+        self.warmed_up = False
 
-    @chat_app.post("/v1/chat/completions")
-    async def create_chat_completion(
-        self, request: ChatCompletionRequest, raw_request: Request
-    ):
-        """OpenAI-compatible HTTP endpoint.
+    def __del__(self):
+        self.usage_ledger.flush()
 
-        API reference:
-            - https://docs.vllm.ai/en/latest/serving/openai_compatible_server.html
+    async def reconfigure(self, config: Dict[str, Any]):
+        """Applies the deployment's user_config.
+
+        Ray Serve calls this before routing any traffic to a new replica, so
+        warming up here keeps cold replicas out of rotation during scale-up
+        and rollouts. Later user_config changes only update the settings.
         """
+        self.lifecycle.configure(config)
+        if not self.warmed_up and config.get("warmup", True):
+            started = time.monotonic()
+            await self.get_serving_chat()
+            sampling_params = SamplingParams(max_tokens=config.get("warmup_tokens", 8))
+            async for _ in self.engine.generate(
+                config.get("warmup_prompt", "Hello"), sampling_params, request_id=f"warmup-{uuid.uuid4()}"
+            ):
+                pass
+            logger.info(f"Warmup finished in {time.monotonic() - started:.1f}s")
+        self.warmed_up = True
+        self.lifecycle.mark_ready()
+
+    async def get_serving_chat(self) -> OpenAIServingChat:
         if not self.openai_serving_chat:
             model_config = await self.engine.get_model_config()
 
@@ -105,6 +139,7 @@ class VLLMDeployment:
             else:
                 base_model_paths = [BaseModelPath(name=self.engine_args.model,
                                                 model_path=self.engine_args.model)]
+            self.served_model_name = base_model_paths[0].name
 
             models = OpenAIServingModels(
                 engine_client=self.engine,
@@ -125,33 +160,168 @@ class VLLMDeployment:
                 enable_auto_tools=True,
                 tool_parser="llama3_json",
             )
-        logger.info(f"Request: {request}")
-        generator = await self.openai_serving_chat.create_chat_completion(
-            request, raw_request
-        )
-        if isinstance(generator, ErrorResponse):
-            return JSONResponse(
-                content=generator.model_dump(), status_code=generator.code
+        return self.openai_serving_chat
+
+    async def stream_with_usage(
+        self, generator: AsyncGenerator[str, None], tenant: str, model: str, started: float, strip_usage: bool
+    ) -> AsyncGenerator[str, None]:
+        """Passes SSE chunks through while picking the usage off the final chunk.
+
+        When usage was only requested for accounting, the usage-only chunk is
+        dropped so the client sees the stream it asked for.
+        """
+        usage = None
+        try:
+            async for chunk in generator:
+                if chunk.startswith("data: {") and '"usage"' in chunk:
+                    payload = json.loads(chunk[len("data: "):])
+                    usage = payload.get("usage") or usage
+                    if strip_usage and not payload.get("choices"):
+                        continue
+                yield chunk
+        finally:
+            await generator.aclose()
+            usage = usage or {}
+            self.usage_ledger.record(
+                tenant,
+                model,
+                usage.get("prompt_tokens", 0),
+                usage.get("completion_tokens", 0),
+                time.monotonic() - started,
             )
+
+    @chat_app.get("/usage")
+    async def usage(self, tenant: Optional[str] = None, model: Optional[str] = None):
+        return JSONResponse(content=self.usage_ledger.snapshot(tenant=tenant, model=model))
+
+    @chat_app.post("/v1/chat/completions")
+    async def create_chat_completion(
+        self, request: ChatCompletionRequest, raw_request: Request
+    ):
+        """OpenAI-compatible HTTP endpoint.
+
+        API reference:
+            - https://docs.vllm.ai/en/latest/serving/openai_compatible_server.html
+        """
+        serving_chat = await self.get_serving_chat()
+        logger.info(f"Request: {request}")
+        tenant = tenant_from(raw_request.headers, {"user": request.user})
+
+        # Streams only carry token counts when the client asks for them, so always ask
+        strip_usage = False
         if request.stream:
-            return StreamingResponse(content=generator, media_type="text/event-stream")
-        else:
-            assert isinstance(generator, ChatCompletionResponse)
-            return JSONResponse(content=generator.model_dump())
+            if request.stream_options is None:
+                request.stream_options = StreamOptions(include_usage=True)
+                strip_usage = True
+            elif not request.stream_options.include_usage:
+                request.stream_options.include_usage = True
+                strip_usage = True
+
+        slot = await self.lifecycle.acquire()
+        handed_off = False
+        try:
+            started = time.monotonic()
+            generator = await serving_chat.create_chat_completion(
+                request, raw_request
+            )
+            if isinstance(generator, ErrorResponse):
+                return JSONResponse(
+                    content=generator.model_dump(), status_code=generator.code
+                )
+            if request.stream:
+                # Usage is keyed on the served model; request.model is optional and client-controlled
+                generator = self.stream_with_usage(generator, tenant, self.served_model_name, started, strip_usage)
+                # The stream owns the admission slot from here; the background task releases it
+                # even if the response is torn down before the stream is iterated
+                generator = self.lifecycle.hand_off(generator, request.request_id, slot)
+                handed_off = True
+                return StreamingResponse(
+                    content=generator, media_type="text/event-stream", background=BackgroundTask(slot.release)
+                )
+            else:
+                assert isinstance(generator, ChatCompletionResponse)
+                self.usage_ledger.record(
+                    tenant,
+                    self.served_model_name,
+                    generator.usage.prompt_tokens,
+                    generator.usage.completion_tokens,
+                    time.monotonic() - started,
+                )
+                return JSONResponse(content=generator.model_dump())
+        finally:
+            if not handed_off:
+                slot.release()
+
+    @chat_app.get("/replica/status")
+    async def replica_status(self):
+        return JSONResponse(content=self.lifecycle.status())
 
 
 # Embedding Application
+class IndexUpsertRequest(BaseModel):
+    ids: List[str]
+    input: Optional[List[str]] = None
+    embeddings: Optional[List[List[float]]] = None
+    metadata: Optional[List[Optional[Dict[str, Any]]]] = None
+
+
+class IndexDeleteRequest(BaseModel):
+    ids: List[str]
+
+
+class IndexQueryRequest(BaseModel):
+    input: Optional[Union[str, List[str]]] = None
+    embeddings: Optional[List[List[float]]] = None
+    top_k: int = 10
+
+
+def error_response(message: str, code: int = 400) -> JSONResponse:
+    error = ErrorResponse(message=message, type="BadRequestError", code=code)
+    return JSONResponse(content=error.model_dump(), status_code=code)
+
+
+def check_single_replica():
+    """Refuses to start replica-local state in a deployment that may run more than one replica.
+
+    Upserts would land on whichever replica Ray picks and queries on another
+    would silently miss them.
+    """
+    try:
+        deployment_config = serve.get_replica_context()._deployment_config
+    except RayServeException:
+        return  # not running inside a Serve replica
+    autoscaling_config = deployment_config.autoscaling_config
+    max_replicas = autoscaling_config.max_replicas if autoscaling_config else deployment_config.num_replicas
+    if max_replicas is not None and max_replicas > 1:
+        raise ValueError(
+            f"The vector index is per-replica state and needs num_replicas: 1 (deployment allows {max_replicas}); "
+            "set VECTOR_INDEX_ENABLED=false to scale out embeddings without it"
+        )
+
+
+INDEX_DISABLED = "The vector index is disabled on this deployment (VECTOR_INDEX_ENABLED=false)"
+
+
 @serve.deployment(name="VLLMEmbeddingDeployment")
 @serve.ingress(embed_app)
 class VLLMEmbeddingDeployment:
-    def __init__(self, engine_args: AsyncEngineArgs):
+    def __init__(self, engine_args: AsyncEngineArgs, index_config: Optional[Dict[str, Any]] = None):
         logger.info(f"Starting embedding engine with args: {engine_args}")
         self.engine_args = engine_args
         self.engine = AsyncLLMEngine.from_engine_args(engine_args)
         self.openai_serving_embedding = None
-
-    @embed_app.post("/v1/embeddings")
-    async def create_embedding(self, request: EmbeddingRequest, raw_request: Request):
+        self.served_model_name = None
+        # Vector index lives in this replica so queries embed and search in one call
+        self.index = None
+        if index_config is not None:
+            check_single_replica()
+            self.index = VectorIndex(**index_config)
+        self.usage_ledger = UsageLedger.from_env()
+
+    def __del__(self):
+        self.usage_ledger.flush()
+
+    async def get_serving_embedding(self) -> OpenAIServingEmbedding:
         if not self.openai_serving_embedding:
             model_config = await self.engine.get_model_config()
 
@@ -162,7 +332,8 @@ class VLLMEmbeddingDeployment:
             else:
                 base_model_paths = [BaseModelPath(name=self.engine_args.model,
                                                 model_path=self.engine_args.model)]
-            
+            self.served_model_name = base_model_paths[0].name
+
             # Create models instance
             models = OpenAIServingModels(
                 engine_client=self.engine,
@@ -180,13 +351,199 @@ class VLLMEmbeddingDeployment:
                 chat_template=None,
                 chat_template_content_format="auto",
             )
+        return self.openai_serving_embedding
+
+    async def embed_texts(self, texts: List[str], raw_request: Request):
+        """Embeds texts in a single engine batch. Returns vectors or an ErrorResponse."""
+        serving_embedding = await self.get_serving_embedding()
+        request = EmbeddingCompletionRequest(model=self.served_model_name, input=texts)
+        started = time.monotonic()
+        response = await serving_embedding.create_embedding(request, raw_request)
+        if isinstance(response, ErrorResponse):
+            return response
+        self.usage_ledger.record(
+            tenant_from(raw_request.headers),
+            self.served_model_name,
+            response.usage.prompt_tokens,
+            0,
+            time.monotonic() - started,
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def create_chunked_embedding(
+        self, request: EmbeddingRequest, chunking: Any, raw_request: Request
+    ) -> JSONResponse:
+        """Embeds inputs longer than the model's context as overlapping token windows.
+
+        Every window of every input goes to the engine in one batch; each
+        input's window vectors are then pooled into a single embedding.
+        """
+        texts = getattr(request, "input", None)
+        texts = [texts] if isinstance(texts, str) else texts
+        if not texts or not all(isinstance(text, str) for text in texts):
+            return error_response("'chunking' requires text input")
+
+        model_config = await self.engine.get_model_config()
+        # Leave room for the special tokens the engine adds around each window
+        max_window = model_config.max_model_len - 16
+        try:
+            options = parse_chunking_options(
+                chunking, default_window=max_window, max_window=max_window, default_overlap=64
+            )
+        except ValueError as e:
+            return error_response(str(e))
+
+        tokenizer = await self.engine.get_tokenizer()
+        encodings = await asyncio.to_thread(
+            tokenizer, texts, add_special_tokens=False, return_offsets_mapping=True
+        )
+        chunks_per_text = [
+            split_text(text, offsets, options) for text, offsets in zip(texts, encodings["offset_mapping"])
+        ]
+
+        vectors = await self.embed_texts([chunk["text"] for chunks in chunks_per_text for chunk in chunks], raw_request)
+        if isinstance(vectors, ErrorResponse):
+            return JSONResponse(content=vectors.model_dump(), status_code=vectors.code)
+
+        data = []
+        position = 0
+        for i, chunks in enumerate(chunks_per_text):
+            chunk_vectors = vectors[position:position + len(chunks)]
+            position += len(chunks)
+            item = {
+                "object": "embedding",
+                "index": i,
+                "embedding": pool(chunk_vectors, [chunk["tokens"] for chunk in chunks], options),
+                "num_chunks": len(chunks),
+            }
+            if options.return_chunks:
+                item["chunks"] = [
+                    {"embedding": vector, "start": chunk["start"], "end": chunk["end"], "tokens": chunk["tokens"]}
+                    for chunk, vector in zip(chunks, chunk_vectors)
+                ]
+            data.append(item)
+
+        prompt_tokens = sum(chunk["tokens"] for chunks in chunks_per_text for chunk in chunks)
+        return JSONResponse(content={
+            "object": "list",
+            "model": self.served_model_name,
+            "data": data,
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        })
+
+    @embed_app.post("/v1/embeddings")
+    async def create_embedding(self, request: EmbeddingRequest, raw_request: Request):
+        serving_embedding = await self.get_serving_embedding()
+
+        # Optional server-side chunking for inputs longer than the model context
+        chunking = (request.model_extra or {}).get("chunking")
+        if chunking is not None and chunking is not False:
+            return await self.create_chunked_embedding(request, chunking, raw_request)
 
         logger.info(f"Embedding Request: {request}")
-        response = await self.openai_serving_embedding.create_embedding(
+        started = time.monotonic()
+        response = await serving_embedding.create_embedding(
             request, raw_request
         )
+        if isinstance(response, EmbeddingResponse):
+            self.usage_ledger.record(
+                tenant_from(raw_request.headers, {"user": request.user}),
+                self.served_model_name,
+                response.usage.prompt_tokens,
+                0,
+                time.monotonic() - started,
+            )
         return JSONResponse(content=response.model_dump())
 
+    @embed_app.get("/usage")
+    async def usage(self, tenant: Optional[str] = None, model: Optional[str] = None):
+        return JSONResponse(content=self.usage_ledger.snapshot(tenant=tenant, model=model))
+
+    @embed_app.get("/v1/index")
+    async def list_namespaces(self):
+        if self.index is None:
+            return error_response(INDEX_DISABLED, code=404)
+        return JSONResponse(content={"namespaces": self.index.stats()})
+
+    @embed_app.post("/v1/index/{namespace}/upsert")
+    async def upsert_vectors(self, namespace: str, request: IndexUpsertRequest, raw_request: Request):
+        if self.index is None:
+            return error_response(INDEX_DISABLED, code=404)
+        if (request.input is None) == (request.embeddings is None):
+            return error_response("Exactly one of 'input' or 'embeddings' is required")
+
+        vectors = request.embeddings
+        if request.input is not None:
+            vectors = await self.embed_texts(request.input, raw_request)
+            if isinstance(vectors, ErrorResponse):
+                return JSONResponse(content=vectors.model_dump(), status_code=vectors.code)
+        if not vectors:
+            return error_response("No vectors to upsert")
+
+        try:
+            index = self.index.get_or_create(namespace, len(vectors[0]))
+            # Row copies, journal writes and ANN updates stay off the event loop
+            inserted = await asyncio.to_thread(index.upsert, request.ids, vectors, request.metadata)
+        except ValueError as e:
+            return error_response(str(e))
+
+        logger.info(f"Upserted {len(request.ids)} vectors into '{namespace}' ({inserted} new)")
+        return JSONResponse(content={
+            "namespace": namespace,
+            "upserted": len(request.ids),
+            "inserted": inserted,
+            "count": index.count,
+        })
+
+    @embed_app.post("/v1/index/{namespace}/delete")
+    async def delete_vectors(self, namespace: str, request: IndexDeleteRequest):
+        if self.index is None:
+            return error_response(INDEX_DISABLED, code=404)
+        index = self.index.get(namespace)
+        if index is None:
+            return error_response(f"Namespace '{namespace}' not found", code=404)
+        deleted = await asyncio.to_thread(index.delete, request.ids)
+        return JSONResponse(content={"namespace": namespace, "deleted": deleted, "count": index.count})
+
+    @embed_app.post("/v1/index/{namespace}/query")
+    async def query_vectors(self, namespace: str, request: IndexQueryRequest, raw_request: Request):
+        if self.index is None:
+            return error_response(INDEX_DISABLED, code=404)
+        index = self.index.get(namespace)
+        if index is None:
+            return error_response(f"Namespace '{namespace}' not found", code=404)
+        if (request.input is None) == (request.embeddings is None):
+            return error_response("Exactly one of 'input' or 'embeddings' is required")
+        if request.top_k < 1:
+            return error_response("'top_k' must be at least 1")
+
+        vectors = request.embeddings
+        if request.input is not None:
+            texts = [request.input] if isinstance(request.input, str) else request.input
+            vectors = await self.embed_texts(texts, raw_request)
+            if isinstance(vectors, ErrorResponse):
+                return JSONResponse(content=vectors.model_dump(), status_code=vectors.code)
+
+        try:
+            # A flat scan is O(rows x dim), so keep it from stalling concurrent embedding requests
+            results = await asyncio.to_thread(index.query, vectors, request.top_k)
+        except ValueError as e:
+            return error_response(str(e))
+
+        return JSONResponse(content={
+            "namespace": namespace,
+            "data": [
+                {
+                    "index": i,
+                    "matches": [
+                        {"id": doc_id, "score": score, "metadata": metadata}
+                        for doc_id, score, metadata in matches
+                    ],
+                }
+                for i, matches in enumerate(results)
+            ],
+        })
+
 
 def build_chat_app(cli_args: Dict[str, str]) -> serve.Application:
     """Builds the Chat Serve application."""
@@ -215,7 +572,18 @@ def build_embedding_app(cli_args: Dict[str, str]) -> serve.Application:
     engine_args.worker_use_ray = True
     engine_args.task = "embed"  # Force task to embed for embedding model
 
-    return VLLMEmbeddingDeployment.bind(engine_args)
+    index_config = None
+    # The index pins the deployment to one replica; disable it to scale out embeddings
+    if os.environ.get("VECTOR_INDEX_ENABLED", "true").lower() not in ("0", "false", "no"):
+        index_config = {
+            "storage_dir": os.environ.get("VECTOR_INDEX_DIR"),  # unset keeps vectors in RAM
+            "metric": os.environ.get("VECTOR_INDEX_METRIC", "cosine"),
+            "ann": os.environ.get("VECTOR_INDEX_ANN", "none"),  # none, ivf or hnsw
+            "nlist": int(os.environ.get("VECTOR_INDEX_NLIST", "64")),
+            "nprobe": int(os.environ.get("VECTOR_INDEX_NPROBE", "8")),
+        }
+
+    return VLLMEmbeddingDeployment.bind(engine_args, index_config)
 
 
 # Create the chat model application by default
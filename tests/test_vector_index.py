@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index import NamespaceIndex  # noqa: E402
+
+pytest.importorskip("hnswlib")
+
+
+def build_hnsw_index(rows=200, dim=16):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(rows, dim)).astype(np.float32)
+    index = NamespaceIndex("test", dim, ann="hnsw", ann_min_rows=100)
+    index.upsert([str(i) for i in range(rows)], vectors.tolist())
+    # The first query starts the background build, the next one applies it
+    index.query(vectors[:1].tolist())
+    index._ann_build.result()
+    index.query(vectors[:1].tolist())
+    assert index._ann_ready
+    return index, vectors, rng
+
+
+def test_hnsw_reupsert_after_delete_replaces_old_vector():
+    index, vectors, rng = build_hnsw_index()
+    index.delete(["0"])
+    new_vector = rng.normal(size=(1, vectors.shape[1]))
+    index.upsert(["5"], new_vector.tolist())
+
+    matches = index.query(vectors[5:6].tolist(), top_k=10)[0]
+    ids = [doc_id for doc_id, _, _ in matches]
+    assert ids.count("5") <= 1
+    assert not (ids[0] == "5" and matches[0][1] > 0.999)
+
+    matches = index.query(new_vector.tolist(), top_k=10)[0]
+    assert matches[0][0] == "5"
+    assert len({doc_id for doc_id, _, _ in matches}) == len(matches)
+    assert index._hnsw.get_current_count() - 1 == len(index._hnsw_labels)
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "anonymous"
+
+
+def tenant_from(headers: Mapping[str, str], body: Optional[Dict[str, Any]] = None) -> str:
+    """Caller identity for accounting: the X-Tenant-Id header (Dapr binding metadata), then the OpenAI ``user`` field."""
+    tenant = headers.get("x-tenant-id")
+    if not tenant and isinstance(body, dict):
+        tenant = body.get("user")
+    return tenant or DEFAULT_TENANT
+
+
+class UsageCounters:
+    __slots__ = ("requests", "prompt_tokens", "completion_tokens", "cached_tokens", "generation_seconds")
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.generation_seconds = 0.0
+
+    def add(self, other: "UsageCounters"):
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cached_tokens += other.cached_tokens
+        self.generation_seconds += other.generation_seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        total_tokens = self.prompt_tokens + self.completion_tokens
+        seconds = self.generation_seconds
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "total_tokens": total_tokens,
+            "generation_seconds": round(seconds, 3),
+            "tokens_per_second": round(total_tokens / seconds, 2) if seconds else 0.0,
+            "completion_tokens_per_second": round(self.completion_tokens / seconds, 2) if seconds else 0.0,
+        }
+
+
+class UsageLedger:
+    """In-process token usage aggregated per (tenant, model).
+
+    Requests are added to the current window. Every ``flush_interval`` seconds
+    the window is appended to ``log_path`` as one JSON line per (tenant, model)
+    and folded into the running totals served by ``snapshot``. Totals are
+    per process; sum the log across replicas for fleet-wide numbers.
+    """
+
+    def __init__(self, log_path: Optional[str] = None, flush_interval: float = 60.0, source: Optional[str] = None):
+        self.log_path = log_path
+        self.flush_interval = flush_interval
+        self.source = source or f"{socket.gethostname()}:{os.getpid()}"
+        self.window: Dict[Tuple[str, str], UsageCounters] = {}
+        self.totals: Dict[Tuple[str, str], UsageCounters] = {}
+        self.window_start = time.time()
+        self.started_at = self.window_start
+        self._flusher: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls) -> "UsageLedger":
+        return cls(
+            log_path=os.getenv("USAGE_LOG_PATH"),
+            flush_interval=float(os.getenv("USAGE_FLUSH_INTERVAL", "60")),
+        )
+
+    def record(
+        self,
+        tenant: str,
+        model: str,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        generation_seconds: float = 0.0,
+        cached_tokens: int = 0,
+    ):
+        counters = self.window.get((tenant, model))
+        if counters is None:
+            counters = self.window[(tenant, model)] = UsageCounters()
+        counters.requests += 1
+        counters.prompt_tokens += prompt_tokens or 0
+        counters.completion_tokens += completion_tokens or 0
+        counters.cached_tokens += cached_tokens or 0
+        counters.generation_seconds += generation_seconds
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and not self._flusher.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._flusher = loop.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing usage ledger: {str(e)}")
+
+    def flush(self):
+        """Close the current window: append it to the log and fold it into the totals."""
+        window, self.window = self.window, {}
+        window_start, window_end = self.window_start, time.time()
+        self.window_start = window_end
+        if not window:
+            return
+
+        for key, counters in window.items():
+            self.totals.setdefault(key, UsageCounters()).add(counters)
+
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                for (tenant, model), counters in window.items():
+                    line = {
+                        "source": self.source,
+                        "window_start": window_start,
+                        "window_end": window_end,
+                        "tenant": tenant,
+                        "model": model,
+                        **counters.to_dict(),
+                    }
+                    f.write(json.dumps(line) + "\n")
+
+    def snapshot(self, tenant: Optional[str] = None, model: Optional[str] = None) -> Dict[str, Any]:
+        """Totals since start including the unflushed window, optionally filtered."""
+        merged: Dict[Tuple[str, str], UsageCounters] = {}
+        for source in (self.totals, self.window):
+            for key, counters in source.items():
+                if (tenant and key[0] != tenant) or (model and key[1] != model):
+                    continue
+                merged.setdefault(key, UsageCounters()).add(counters)
+
+        rows: List[Dict[str, Any]] = [
+            {"tenant": key[0], "model": key[1], **counters.to_dict()}
+            for key, counters in sorted(merged.items(), key=lambda item: (str(item[0][0]), str(item[0][1])))
+        ]
+        return {"source": self.source, "since": self.started_at, "usage": rows}
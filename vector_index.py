@@ -0,0 +1,588 @@
+import fcntl
+import json
+import os
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("ray.serve")
+
+try:
+    import hnswlib
+except ImportError:  # optional, only needed for ann="hnsw"
+    hnswlib = None
+
+SUPPORTED_METRICS = ("cosine", "ip")
+SUPPORTED_ANN = ("none", "ivf", "hnsw")
+
+# ANN training and snapshot compaction run here so they never block the event loop
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vector-index")
+
+
+class NamespaceIndex:
+    """Embeddings for a single namespace stored in one contiguous float32 array.
+
+    Rows are kept dense: deleting a row moves the last row into its slot, so a
+    brute-force scan is always a single matrix product over ``vectors[:count]``.
+    When ``storage_dir`` is set the array is a ``np.memmap`` backed by
+    ``<namespace>.f32``. Ids and metadata are persisted as a JSON snapshot
+    plus an append-only journal of upserts and deletes, which is compacted
+    into a new snapshot in the background once it outgrows the namespace.
+
+    ``ann`` optionally adds an approximate search structure on top of the flat
+    array. It is trained in a background thread once the namespace reaches
+    ``ann_min_rows`` (queries scan the flat array meanwhile) and afterwards
+    kept current incrementally: new IVF rows join their nearest existing
+    centroid and HNSW items are added or marked deleted in place. IVF
+    centroids are retrained in the background when the namespace has grown
+    ``ivf_retrain_growth`` times past the size they were trained on, while the
+    old centroids keep serving.
+
+    ``upsert``, ``delete`` and ``query`` hold a per-namespace lock, so callers
+    can run them in worker threads to keep scans off the event loop.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        dim: int,
+        metric: str = "cosine",
+        storage_dir: Optional[str] = None,
+        ann: str = "none",
+        nlist: int = 64,
+        nprobe: int = 8,
+        ann_min_rows: int = 4096,
+        ivf_retrain_growth: float = 4.0,
+    ):
+        if metric not in SUPPORTED_METRICS:
+            raise ValueError(f"Unsupported metric '{metric}', expected one of {SUPPORTED_METRICS}")
+        if ann not in SUPPORTED_ANN:
+            raise ValueError(f"Unsupported ann '{ann}', expected one of {SUPPORTED_ANN}")
+        if ann == "hnsw" and hnswlib is None:
+            raise ValueError("ann='hnsw' requires the hnswlib package")
+
+        self.namespace = namespace
+        self.dim = dim
+        self.metric = metric
+        self.storage_dir = storage_dir
+        self.ann = ann
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ann_min_rows = ann_min_rows
+        self.ivf_retrain_growth = ivf_retrain_growth
+
+        self.ids: List[str] = []
+        self.metadata: List[Optional[Dict[str, Any]]] = []
+        self.id_to_row: Dict[str, int] = {}
+        self.count = 0
+        self.vectors = self._allocate(1024)
+        # upsert/delete/query run in worker threads; one at a time per namespace
+        self._lock = threading.Lock()
+
+        # Persistence: snapshot generation, open journal and how much it holds
+        self.generation = 0
+        self._journal_file = None
+        self._journal_rows = 0
+        self._compaction: Optional[Future] = None
+
+        # ANN state. While a build runs, ids touched since its snapshot are
+        # collected in _ann_pending and patched in when the build is applied.
+        self._ann_ready = False
+        self._ann_build: Optional[Future] = None
+        self._ann_pending: Set[str] = set()
+        self._ann_trained_rows = 0
+        self._ivf_centroids: Optional[np.ndarray] = None
+        self._ivf_assign: Optional[np.ndarray] = None
+        self._hnsw = None
+        self._hnsw_labels: Dict[str, int] = {}
+        self._hnsw_ids: Dict[int, str] = {}
+        self._hnsw_next_label = 0
+
+    # Storage
+
+    def _data_path(self) -> str:
+        return os.path.join(self.storage_dir, f"{self.namespace}.f32")
+
+    def _meta_path(self) -> str:
+        return os.path.join(self.storage_dir, f"{self.namespace}.json")
+
+    def _journal_path(self, generation: int) -> str:
+        return os.path.join(self.storage_dir, f"{self.namespace}.{generation}.log")
+
+    def _allocate(self, capacity: int) -> np.ndarray:
+        if self.storage_dir is None:
+            return np.zeros((capacity, self.dim), dtype=np.float32)
+        return np.memmap(self._data_path(), dtype=np.float32, mode="w+", shape=(capacity, self.dim))
+
+    def _grow(self, needed: int):
+        capacity = self.vectors.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        if self.storage_dir is None:
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[: self.count] = self.vectors[: self.count]
+        else:
+            # Extend the backing file in place and remap it with the larger shape. A background
+            # build still holding the old mapping keeps reading valid (unchanged) pages.
+            self.vectors.flush()
+            with open(self._data_path(), "r+b") as f:
+                f.truncate(capacity * self.dim * 4)
+            grown = np.memmap(self._data_path(), dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self.vectors = grown
+
+    def _snapshot_state(self) -> Dict[str, Any]:
+        return {
+            "dim": self.dim,
+            "metric": self.metric,
+            "generation": self.generation,
+            "ids": list(self.ids),
+            "metadata": list(self.metadata),
+        }
+
+    @staticmethod
+    def _write_snapshot(path: str, state: Dict[str, Any], vectors: np.ndarray, stale_journals: List[str]):
+        if isinstance(vectors, np.memmap):
+            vectors.flush()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+        # Only once the snapshot covering them is in place
+        for journal in stale_journals:
+            if os.path.exists(journal):
+                os.remove(journal)
+
+    def _rotate_journal(self) -> Tuple[Dict[str, Any], List[str]]:
+        """Start a new journal generation and return the snapshot state that replaces the old ones."""
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        stale = [
+            os.path.join(self.storage_dir, name)
+            for name in os.listdir(self.storage_dir)
+            if name.startswith(f"{self.namespace}.") and name.endswith(".log")
+        ]
+        self.generation += 1
+        self._journal_rows = 0
+        return self._snapshot_state(), stale
+
+    def save(self):
+        """Write a full snapshot synchronously. Used when a namespace is created or loaded."""
+        if self.storage_dir is None:
+            return
+        state, stale = self._rotate_journal()
+        self._write_snapshot(self._meta_path(), state, self.vectors, stale)
+
+    def _compact_in_background(self):
+        if self._compaction is not None and not self._compaction.done():
+            return
+        # Copying the id/metadata lists is cheap; serializing them happens off the loop
+        state, stale = self._rotate_journal()
+        self._compaction = _background.submit(self._write_snapshot, self._meta_path(), state, self.vectors, stale)
+
+    def _journal(self, record: Dict[str, Any], rows: int):
+        if self.storage_dir is None:
+            return
+        if self._journal_file is None:
+            self._journal_file = open(self._journal_path(self.generation), "a")
+        self._journal_file.write(json.dumps(record) + "\n")
+        self._journal_file.flush()
+        self._journal_rows += rows
+        # Compacting once the journal holds as many rows as the namespace keeps the cost amortized O(1)
+        if self._journal_rows > max(self.count, 1024):
+            self._compact_in_background()
+
+    @classmethod
+    def load(cls, namespace: str, storage_dir: str, **kwargs) -> "NamespaceIndex":
+        with open(os.path.join(storage_dir, f"{namespace}.json")) as f:
+            state = json.load(f)
+        index = cls(namespace, state["dim"], metric=state["metric"], **kwargs)
+        index.storage_dir = storage_dir
+        capacity = max(os.path.getsize(index._data_path()) // (state["dim"] * 4), 1)
+        index.vectors = np.memmap(index._data_path(), dtype=np.float32, mode="r+", shape=(capacity, state["dim"]))
+        index.ids = state["ids"]
+        index.metadata = state["metadata"]
+        index.count = len(index.ids)
+        index.id_to_row = {doc_id: row for row, doc_id in enumerate(index.ids)}
+        index.generation = state.get("generation", 0)
+
+        # The vectors file already reflects every journaled write; replay only moves the bookkeeping forward
+        generations = sorted(
+            int(name.split(".")[1])
+            for name in os.listdir(storage_dir)
+            if name.startswith(f"{namespace}.") and name.endswith(".log")
+        )
+        for generation in generations:
+            if generation < index.generation:
+                continue  # already folded into the snapshot
+            with open(index._journal_path(generation)) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record["op"] == "upsert":
+                        index._place(record["ids"], record.get("metadata"))
+                    else:
+                        index._remove(record["ids"], move_vectors=False)
+        index.generation = max([index.generation, *generations])
+        index.save()
+        return index
+
+    # Mutations
+
+    def _prepare(self, vectors: Sequence[Sequence[float]]) -> np.ndarray:
+        array = np.asarray(vectors, dtype=np.float32)
+        if array.ndim != 2 or array.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got shape {array.shape}")
+        if self.metric == "cosine":
+            norms = np.linalg.norm(array, axis=1, keepdims=True)
+            array = array / np.maximum(norms, 1e-12)
+        return array
+
+    def _place(self, ids: Sequence[str], metadata: Optional[Sequence[Optional[Dict[str, Any]]]]) -> List[int]:
+        """Assign a row to every id, appending new ones. Returns the row for each position."""
+        rows = []
+        for i, doc_id in enumerate(ids):
+            row = self.id_to_row.get(doc_id)
+            if row is None:
+                row = self.count
+                self.id_to_row[doc_id] = row
+                self.ids.append(doc_id)
+                self.metadata.append(None)
+                self.count += 1
+            if metadata is not None:
+                self.metadata[row] = metadata[i]
+            rows.append(row)
+        return rows
+
+    def _remove(self, ids: Sequence[str], move_vectors: bool = True) -> List[str]:
+        """Drop ids, moving the last row into each freed slot. Returns the ids actually removed."""
+        removed = []
+        for doc_id in ids:
+            row = self.id_to_row.pop(doc_id, None)
+            if row is None:
+                continue
+            last = self.count - 1
+            if row != last:
+                moved_id = self.ids[last]
+                if move_vectors:
+                    self.vectors[row] = self.vectors[last]
+                    self._ann_move(moved_id, row, last)
+                self.ids[row] = moved_id
+                self.metadata[row] = self.metadata[last]
+                self.id_to_row[moved_id] = row
+            self.ids.pop()
+            self.metadata.pop()
+            self.count -= 1
+            removed.append(doc_id)
+        return removed
+
+    def upsert(
+        self,
+        ids: Sequence[str],
+        vectors: Sequence[Sequence[float]],
+        metadata: Optional[Sequence[Optional[Dict[str, Any]]]] = None,
+    ) -> int:
+        """Insert or overwrite rows. Returns the number of newly inserted ids."""
+        if len(ids) != len(vectors):
+            raise ValueError("ids and vectors must have the same length")
+        if metadata is not None and len(metadata) != len(ids):
+            raise ValueError("metadata must have the same length as ids")
+        array = self._prepare(vectors)
+        with self._lock:
+            new_ids = [doc_id for doc_id in dict.fromkeys(ids) if doc_id not in self.id_to_row]
+            self._grow(self.count + len(new_ids))
+
+            for i, row in enumerate(self._place(ids, metadata)):
+                self.vectors[row] = array[i]
+
+            self._ann_upserted(list(dict.fromkeys(ids)))
+            record = {"op": "upsert", "ids": list(ids), "metadata": list(metadata) if metadata is not None else None}
+            self._journal(record, len(ids))
+            return len(new_ids)
+
+    def delete(self, ids: Sequence[str]) -> int:
+        """Remove rows by id, keeping the array dense. Returns the number removed."""
+        with self._lock:
+            removed = self._remove(ids)
+            if removed:
+                self._ann_deleted(removed)
+                self._journal({"op": "delete", "ids": removed}, len(removed))
+            return len(removed)
+
+    # ANN structures
+
+    def _train_ivf(self, vectors: np.ndarray, count: int) -> Tuple[np.ndarray, np.ndarray]:
+        data = np.array(vectors[:count])
+        nlist = min(self.nlist, count)
+        rng = np.random.default_rng(0)
+        centroids = data[rng.choice(count, size=nlist, replace=False)].copy()
+
+        # A few rounds of spherical k-means are enough for coarse routing
+        for _ in range(10):
+            assignments = np.argmax(data @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = data[assignments == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            if self.metric == "cosine":
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        return centroids, np.argmax(data @ centroids.T, axis=1).astype(np.int32)
+
+    def _train_hnsw(self, vectors: np.ndarray, ids: List[str]):
+        count = len(ids)
+        index = hnswlib.Index(space="ip", dim=self.dim)
+        index.init_index(max_elements=max(count * 2, 1024), ef_construction=200, M=16, allow_replace_deleted=True)
+        index.add_items(np.asarray(vectors[:count]), np.arange(count))
+        return index, {doc_id: label for label, doc_id in enumerate(ids)}
+
+    def _start_ann_build(self):
+        logger.info(f"Training {self.ann} index for namespace '{self.namespace}' ({self.count} rows) in the background")
+        self._ann_pending = set()
+        self._ann_trained_rows = self.count
+        if self.ann == "ivf":
+            self._ann_build = _background.submit(self._train_ivf, self.vectors, self.count)
+        else:
+            self._ann_build = _background.submit(self._train_hnsw, self.vectors, list(self.ids))
+
+    def _apply_ann_build(self):
+        build, self._ann_build = self._ann_build, None
+        pending, self._ann_pending = self._ann_pending, set()
+        try:
+            result = build.result()
+        except Exception as e:
+            logger.error(f"Building {self.ann} index for namespace '{self.namespace}' failed, using flat scans: {e}")
+            self.ann = "none"
+            return
+
+        # Rows of ids not in pending are unchanged since the build's snapshot
+        if self.ann == "ivf":
+            centroids, trained = result
+            assign = np.zeros(self.vectors.shape[0], dtype=np.int32)
+            kept = min(len(trained), self.count)
+            assign[:kept] = trained[:kept]
+            self._ivf_centroids = centroids
+            self._ivf_assign = assign
+            self._ivf_add([self.id_to_row[doc_id] for doc_id in pending if doc_id in self.id_to_row])
+        else:
+            self._hnsw, self._hnsw_labels = result
+            self._hnsw_ids = {label: doc_id for doc_id, label in self._hnsw_labels.items()}
+            self._hnsw_next_label = len(self._hnsw_labels)
+            self._hnsw_delete([doc_id for doc_id in pending if doc_id not in self.id_to_row])
+            self._hnsw_add([doc_id for doc_id in pending if doc_id in self.id_to_row])
+        self._ann_ready = True
+
+    def _ivf_add(self, rows: List[int]):
+        if not rows:
+            return
+        if self._ivf_assign.shape[0] < self.vectors.shape[0]:
+            grown = np.zeros(self.vectors.shape[0], dtype=np.int32)
+            grown[: self._ivf_assign.shape[0]] = self._ivf_assign
+            self._ivf_assign = grown
+        rows = np.asarray(rows)
+        self._ivf_assign[rows] = np.argmax(self.vectors[rows] @ self._ivf_centroids.T, axis=1)
+
+    def _hnsw_add(self, ids: List[str]):
+        existing = [doc_id for doc_id in ids if doc_id in self._hnsw_labels]
+        new = [doc_id for doc_id in ids if doc_id not in self._hnsw_labels]
+
+        # Ids that already have a label are updated in place. replace_deleted would move the label
+        # into a free deleted slot and leave the old element searchable with the old vector.
+        if existing:
+            rows = [self.id_to_row[doc_id] for doc_id in existing]
+            labels = [self._hnsw_labels[doc_id] for doc_id in existing]
+            self._hnsw.add_items(np.asarray(self.vectors[rows]), np.asarray(labels), replace_deleted=False)
+
+        if new:
+            labels = []
+            for doc_id in new:
+                label = self._hnsw_labels[doc_id] = self._hnsw_next_label
+                self._hnsw_ids[label] = doc_id
+                self._hnsw_next_label += 1
+                labels.append(label)
+            if self._hnsw.get_current_count() + len(new) > self._hnsw.get_max_elements():
+                self._hnsw.resize_index(max(self._hnsw.get_max_elements(), self.count) * 2)
+            rows = [self.id_to_row[doc_id] for doc_id in new]
+            # New labels may take over slots freed by mark_deleted
+            self._hnsw.add_items(np.asarray(self.vectors[rows]), np.asarray(labels), replace_deleted=True)
+
+    def _hnsw_delete(self, ids: List[str]):
+        for doc_id in ids:
+            label = self._hnsw_labels.pop(doc_id, None)
+            if label is not None:
+                self._hnsw.mark_deleted(label)
+                del self._hnsw_ids[label]
+
+    def _ann_upserted(self, ids: List[str]):
+        if self._ann_build is not None:
+            self._ann_pending.update(ids)
+        if not self._ann_ready:
+            return
+        if self.ann == "ivf":
+            self._ivf_add([self.id_to_row[doc_id] for doc_id in ids])
+        elif self.ann == "hnsw":
+            self._hnsw_add(ids)
+
+    def _ann_deleted(self, ids: List[str]):
+        if self._ann_build is not None:
+            self._ann_pending.update(ids)
+        if self._ann_ready and self.ann == "hnsw":
+            self._hnsw_delete(ids)
+
+    def _ann_move(self, moved_id: str, row: int, last: int):
+        # HNSW labels follow ids, so only IVF assignments (indexed by row) move with the row
+        if self._ann_build is not None:
+            self._ann_pending.add(moved_id)
+        if self._ann_ready and self.ann == "ivf":
+            self._ivf_assign[row] = self._ivf_assign[last]
+
+    def _ann_usable(self) -> bool:
+        """Apply a finished build and start one if due. Returns whether the ANN structure can serve queries."""
+        if self.ann == "none":
+            return False
+        if self._ann_build is not None and self._ann_build.done():
+            self._apply_ann_build()
+        if self._ann_build is None and self.count >= self.ann_min_rows:
+            if not self._ann_ready or (
+                self.ann == "ivf" and self.count >= self._ann_trained_rows * self.ivf_retrain_growth
+            ):
+                self._start_ann_build()
+        return self._ann_ready and self.ann != "none" and self.count >= self.ann_min_rows
+
+    # Queries
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        if k >= len(scores):
+            return np.argsort(-scores)
+        candidates = np.argpartition(-scores, k)[:k]
+        return candidates[np.argsort(-scores[candidates])]
+
+    def query(
+        self, vectors: Sequence[Sequence[float]], top_k: int = 10
+    ) -> List[List[Tuple[str, float, Optional[Dict[str, Any]]]]]:
+        """Return the ``top_k`` (id, score, metadata) matches for each query vector."""
+        queries = self._prepare(vectors)
+        with self._lock:
+            if self.count == 0:
+                return [[] for _ in range(len(queries))]
+            top_k = min(top_k, self.count)
+
+            rows_per_query: List[np.ndarray] = []
+            scores_per_query: List[np.ndarray] = []
+            use_ann = self._ann_usable()
+            if use_ann and self.ann == "hnsw":
+                self._hnsw.set_ef(max(top_k * 2, 50))
+                labels, distances = self._hnsw.knn_query(queries, k=top_k)
+                # hnswlib's "ip" space returns 1 - dot product
+                rows_per_query = [[self.id_to_row[self._hnsw_ids[label]] for label in row] for row in labels]
+                scores_per_query = list(1.0 - distances)
+            elif use_ann and self.ann == "ivf":
+                probe = np.argsort(-(queries @ self._ivf_centroids.T), axis=1)[:, : self.nprobe]
+                assign = self._ivf_assign[: self.count]
+                for q, lists in enumerate(probe):
+                    candidates = np.flatnonzero(np.isin(assign, lists))
+                    scores = self.vectors[candidates] @ queries[q]
+                    order = self._top_k(scores, top_k)
+                    rows_per_query.append(candidates[order])
+                    scores_per_query.append(scores[order])
+            else:
+                scores = queries @ self.vectors[: self.count].T
+                for q in range(len(queries)):
+                    order = self._top_k(scores[q], top_k)
+                    rows_per_query.append(order)
+                    scores_per_query.append(scores[q][order])
+
+            return [
+                [(self.ids[row], float(score), self.metadata[row]) for row, score in zip(rows, scores)]
+                for rows, scores in zip(rows_per_query, scores_per_query)
+            ]
+
+
+class VectorIndex:
+    """Collection of per-namespace indexes living inside one embedding replica.
+
+    Namespaces are created on first upsert with the dimension of the vectors
+    written to them. With ``storage_dir`` set, existing namespaces are reopened
+    from disk at startup. The directory is locked for the life of the process,
+    since two indexes writing the same files would corrupt them; a second
+    process waits up to ``lock_timeout`` seconds (e.g. for a replica that is
+    still draining during a rollout) and then fails.
+    """
+
+    def __init__(
+        self,
+        storage_dir: Optional[str] = None,
+        metric: str = "cosine",
+        ann: str = "none",
+        nlist: int = 64,
+        nprobe: int = 8,
+        lock_timeout: float = 300.0,
+    ):
+        self.storage_dir = storage_dir
+        self.metric = metric
+        self.ann_kwargs = {"ann": ann, "nlist": nlist, "nprobe": nprobe}
+        self.namespaces: Dict[str, NamespaceIndex] = {}
+
+        self._lock_file = None
+        if storage_dir is not None:
+            os.makedirs(storage_dir, exist_ok=True)
+            self._lock_storage(lock_timeout)
+            for name in sorted(os.listdir(storage_dir)):
+                if name.endswith(".json"):
+                    namespace = name[: -len(".json")]
+                    self.namespaces[namespace] = NamespaceIndex.load(namespace, storage_dir, **self.ann_kwargs)
+                    logger.info(f"Loaded vector namespace '{namespace}' ({self.namespaces[namespace].count} rows)")
+
+    def _lock_storage(self, timeout: float):
+        self._lock_file = open(os.path.join(self.storage_dir, ".lock"), "w")
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self._lock_file.close()
+                    raise RuntimeError(
+                        f"Vector index directory '{self.storage_dir}' is in use by another process; "
+                        "the index supports a single replica"
+                    )
+                logger.info(f"Waiting for vector index directory '{self.storage_dir}' to be released")
+                time.sleep(5)
+
+    def get(self, namespace: str) -> Optional[NamespaceIndex]:
+        return self.namespaces.get(namespace)
+
+    def get_or_create(self, namespace: str, dim: int) -> NamespaceIndex:
+        index = self.namespaces.get(namespace)
+        if index is None:
+            if not namespace.replace("-", "").replace("_", "").isalnum():
+                raise ValueError(f"Invalid namespace '{namespace}'")
+            index = NamespaceIndex(
+                namespace, dim, metric=self.metric, storage_dir=self.storage_dir, **self.ann_kwargs
+            )
+            # An empty snapshot makes the namespace discoverable on restart
+            index.save()
+            self.namespaces[namespace] = index
+        return index
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "count": index.count,
+                "dim": index.dim,
+                "metric": index.metric,
+                "ann": index.ann,
+                "ann_ready": index._ann_ready,
+                "ann_building": index._ann_build is not None,
+            }
+            for name, index in self.namespaces.items()
+        }